@@ -0,0 +1,55 @@
+# _jsonutil.py：LLM 輸出的 JSON 解析小工具（Agent A / C 共用）
+from typing import Any, Iterator, Optional
+
+import orjson
+
+
+def loads_or_none(text: str) -> Optional[Any]:
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return None
+
+
+def _match_close(text: str, start: int, open_ch: str, close_ch: str) -> Optional[int]:
+    """從 text[start]（open_ch）往後找與它配對的 close_ch 位置；會略過 JSON 字串內的括號"""
+    depth = 0
+    in_str = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == open_ch:
+            depth += 1
+        elif ch == close_ch:
+            depth -= 1
+            if depth == 0:
+                return i
+
+    return None
+
+
+def iter_balanced(text: str, open_ch: str, close_ch: str) -> Iterator[str]:
+    """
+    依序 yield text 中每個 open_ch 到與它配對的 close_ch（含）的區塊；
+    呼叫端不接受某個區塊時，會從它的下一個 open_ch 繼續找。
+    """
+    start = text.find(open_ch)
+    while start >= 0:
+        end = _match_close(text, start, open_ch, close_ch)
+        if end is not None:
+            yield text[start : end + 1]
+        start = text.find(open_ch, start + 1)
+
+
+def extract_balanced(text: str, open_ch: str, close_ch: str) -> Optional[str]:
+    """取出 text 中第一個配對完整的 open_ch ... close_ch 區塊；找不到就回傳 None"""
+    return next(iter_balanced(text, open_ch, close_ch), None)
@@ -0,0 +1,35 @@
+# _llm.py：Ollama 串流呼叫（Agent A / C / D 共用）
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import ollama
+
+# 模型常駐時間（例如 30m）；未設定時沿用 Ollama server 的預設（5 分鐘或 server 的 OLLAMA_KEEP_ALIVE）
+# 模型被卸載後，下一次呼叫就無法重用共用前綴的 KV cache
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE") or None
+
+def stream_chat(model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> Iterator[str]:
+    """逐段 yield LLM 輸出；呼叫端提早停止迭代時，連線會被關閉、Ollama 停止生成"""
+    stream = ollama.chat(
+        model=model, messages=messages, options=options, stream=True, keep_alive=LLM_KEEP_ALIVE
+    )
+    try:
+        for chunk in stream:
+            yield chunk["message"]["content"]
+    finally:
+        stream.close()
+
+
+def chat_until(
+    model: str,
+    messages: List[Dict[str, str]],
+    options: Dict[str, Any],
+    is_done: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """串流累積輸出；is_done(buf) 為 True 時立即中止生成並回傳目前內容"""
+    buf = ""
+    for delta in stream_chat(model, messages, options):
+        buf += delta
+        if is_done is not None and is_done(buf):
+            break
+    return buf
@@ -0,0 +1,78 @@
+# _models.py：Agent 共用的 embedding 模型與 FAISS index（整個 process 只載入一次）
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sentence_transformers import SentenceTransformer
+
+
+# ===== 路徑 =====
+OUT_DIR = Path("index_out")
+INDEX_PATH = OUT_DIR / "faiss.index"
+META_PATH = OUT_DIR / "meta.parquet"
+
+# ===== 模型 =====
+EMB_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# 推論後端：torch（預設）/ onnx（需 pip install "sentence-transformers[onnx]"）
+EMB_BACKEND = os.getenv("EMB_BACKEND", "torch")
+# onnx 後端可指定量化模型檔，例如 onnx/model_qint8_avx512_vnni.onnx（int8 動態量化）
+EMB_ONNX_FILE = os.getenv("EMB_ONNX_FILE", "")
+
+# ===== 檢索參數 =====
+IVF_NPROBE = 16                # IVF index 每次查詢掃描的 list 數
+HNSW_EF_SEARCH = 64            # HNSW 搜尋寬度（FAISS 實際會取 max(efSearch, k)）
+
+
+@lru_cache(maxsize=1)
+def get_embedder() -> SentenceTransformer:
+    if EMB_BACKEND == "onnx":
+        model_kwargs = {"file_name": EMB_ONNX_FILE} if EMB_ONNX_FILE else None
+        embedder = SentenceTransformer(EMB_MODEL, backend="onnx", model_kwargs=model_kwargs)
+    else:
+        embedder = SentenceTransformer(EMB_MODEL)
+    embedder.encode(["warmup"], show_progress_bar=False)  # 預熱，避免第一個請求吃到初始化成本
+    return embedder
+
+
+@lru_cache(maxsize=1)
+def get_index() -> faiss.Index:
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+    index = faiss.read_index(str(INDEX_PATH))
+    # IndexIDMap2 包著實際的 index，查詢參數要設在內層
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(IVF_NPROBE, base.nlist)
+    elif isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+
+@lru_cache(maxsize=1)
+def get_meta() -> pa.Table:
+    """meta 以 memory map 方式讀取；row index 即 meta_id"""
+    return pq.read_table(str(META_PATH), memory_map=True)
+
+
+@lru_cache(maxsize=1)
+def get_vec_id_lookup():
+    """排序後的 vec_id 與對應的 meta row；舊版 meta 沒有 vec_id（index 回傳的就是 row）時為 None"""
+    meta = get_meta()
+    if "vec_id" not in meta.column_names:
+        return None
+    vec_ids = meta.column("vec_id").to_numpy()
+    order = np.argsort(vec_ids)
+    return vec_ids[order], order
+
+
+def vec_ids_to_rows(ids: np.ndarray) -> np.ndarray:
+    """FAISS 回傳的 vec_id -> meta row（meta_id）；查不到（含 -1）回傳 -1"""
+    lookup = get_vec_id_lookup()
+    if lookup is None:
+        return ids
+    sorted_ids, order = lookup
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[pos] == ids, order[pos], -1)
@@ -1,22 +1,18 @@
 import json
 import re
 from pathlib import Path
-from collections import defaultdict
 from typing import Dict, List, Tuple, Any, Optional
 
-import faiss
-from sentence_transformers import SentenceTransformer
-import ollama
+import numpy as np
 
+from agents._jsonutil import iter_balanced, loads_or_none
+from agents._llm import chat_until
+from agents._models import get_embedder, get_index, get_meta, vec_ids_to_rows
 
-# ===== 路徑 =====
-OUT_DIR = Path("index_out")
-INDEX_PATH = OUT_DIR / "faiss.index"
-META_PATH = OUT_DIR / "meta.json"
 
 # ===== 模型 =====
-EMB_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 LLM_MODEL = "llama3"  # 若你 Ollama 沒有 llama3，可改 qwen2.5:7b / qwen2.5:3b
+LLM_OPTIONS = {"temperature": 0}
 
 # ===== 控制參數 =====
 RETRIEVE_TOPK = 500
@@ -26,15 +22,50 @@ CITE_CHUNK_MAXLEN = 160        # 最終輸出 source_chunks 時的節錄長度
 
 
 # ===== 讀取 index / meta =====
-index = faiss.read_index(str(INDEX_PATH))
-meta = json.loads(META_PATH.read_text(encoding="utf-8"))
+index = get_index()
+meta = get_meta()
 
-embedder = SentenceTransformer(EMB_MODEL)
+
+def _meta_column(name: str, default: Any = None) -> List[Any]:
+    if name not in meta.column_names:
+        return [default] * meta.num_rows
+    return meta.column(name).to_pylist()
+
+
+# 小欄位一次轉成 list；chunk 原文留在 arrow（memory map），用到才取
+meta_company = _meta_column("company", "")
+meta_company_id = _meta_column("company_id")
+meta_year = _meta_column("year", "")
+meta_page = _meta_column("page", "")
+meta_chunk = meta.column("chunk")
+
+# company 轉成 int 編碼（meta_id -> company code），空公司名記為 -1
+_company_dict = meta.column("company").combine_chunks().dictionary_encode()
+company_names: List[str] = _company_dict.dictionary.to_pylist()
+company_codes = _company_dict.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32)
+company_codes[np.isin(company_codes, [k for k, n in enumerate(company_names) if not n])] = -1
+company_code_of = {n: k for k, n in enumerate(company_names) if n}
+
+embedder = get_embedder()
 
 
 # ===== 小工具 =====
+_WS_RE = re.compile(r"\s+")
+# 刪除所有空白字元（與 \s 相同的字元集合；最大的空白字元是 U+3000）
+_WS_TABLE = dict.fromkeys(i for i in range(0x3001) if chr(i).isspace())
+
+
 def normalize_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", s or "").strip()
+    return _WS_RE.sub(" ", s or "").strip()
+
+
+def norm_name(s: str) -> str:
+    """公司名比對用：去掉所有空白、小寫"""
+    return (s or "").translate(_WS_TABLE).lower()
+
+
+# 與 company_names 對齊的 normalized 公司名（空公司名的 code 已是 -1，不會被比到）
+company_names_norm = [norm_name(n) for n in company_names]
 
 
 def truncate(s: str, max_len: int) -> str:
@@ -48,16 +79,16 @@ def dedupe_claims(claims: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     依照 (company, claim_text, topic, metric) 去重，
     同一承諾若出現多次，就合併 citations & source_chunks。
+    合併時只會整個替換 list 欄位，所以淺拷貝即可（不修改輸入的 dict）。
     """
-    from copy import deepcopy
-
     seen = {}
     result = []
 
     for c in claims:
+        claim_text = normalize_ws(c.get("claim_text", ""))
         key = (
             c.get("company", ""),
-            normalize_ws(c.get("claim_text", "")),
+            claim_text,
             c.get("topic", ""),
             c.get("metric", ""),
         )
@@ -74,57 +105,83 @@ def dedupe_claims(claims: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
             chunks_new = c.get("source_chunks", []) or []
             existing["source_chunks"] = chunks_old + chunks_new
         else:
-            clone = deepcopy(c)
+            clone = dict(c)
             seen[key] = clone
             result.append(clone)
 
     return result
 
 
+def retrieve_raw(query: str, topk: int = 50) -> Dict[str, np.ndarray]:
+    """
+    從 FAISS 取回 topk，只回傳欄式結果（不建 dict）：
+      - meta_ids：meta 原始編號（依分數由高到低）
+      - scores：對應的相似度
+    """
+    q_emb = np.ascontiguousarray(
+        embedder.encode(
+            [query], normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+        ),
+        dtype=np.float32,
+    )
+    scores, ids = index.search(q_emb, topk)
+
+    meta_ids = vec_ids_to_rows(ids[0])
+    keep = meta_ids >= 0
+    return {"meta_ids": meta_ids[keep], "scores": scores[0][keep]}
+
+
+def select_hits(hits: Dict[str, np.ndarray], mask: np.ndarray) -> Dict[str, np.ndarray]:
+    return {"meta_ids": hits["meta_ids"][mask], "scores": hits["scores"][mask]}
+
+
+def build_passage(mid: int, score: float) -> Dict[str, Any]:
+    return {
+        "meta_id": int(mid),  # ✅ 關鍵：保留 meta 原始編號
+        "score": float(score),
+        "company": meta_company[mid],
+        "company_id": meta_company_id[mid],
+        "year": meta_year[mid],
+        "page": meta_page[mid],
+        "chunk": normalize_ws(meta_chunk[mid].as_py()),
+    }
+
+
 def retrieve_all(query: str, topk: int = 50) -> List[Dict[str, Any]]:
     """
     從 FAISS 取回 topk
     新增 meta_id（= i）保留原始 chunk 身分
     """
-    q_emb = embedder.encode([query], normalize_embeddings=True)
-    scores, ids = index.search(q_emb, topk)
-
-    results = []
-    for i, s in zip(ids[0], scores[0]):
-        if i < 0:
-            continue
-        m = meta[i]
-        results.append(
-            {
-                "meta_id": int(i),  # ✅ 關鍵：保留 meta 原始編號
-                "score": float(s),
-                "company": m.get("company", ""),
-                "company_id": m.get("company_id", None),
-                "year": m.get("year", ""),
-                "page": m.get("page", ""),
-                "chunk": normalize_ws(m.get("chunk", "")),
-            }
-        )
-    return results
+    hits = retrieve_raw(query, topk)
+    return [build_passage(i, s) for i, s in zip(hits["meta_ids"], hits["scores"])]
 
 
-def rank_companies(results: List[Dict[str, Any]], topn: int = 3) -> List[Tuple[str, float]]:
-    agg = defaultdict(float)
-    for r in results:
-        c = r.get("company")
-        if c:
-            agg[c] += r["score"]
+def rank_companies(hits: Dict[str, np.ndarray], topn: int = 3) -> List[Tuple[str, float]]:
+    """依公司加總分數（np.bincount），回傳分數最高的 topn 家"""
+    codes = company_codes[hits["meta_ids"]]
+    keep = codes >= 0
+    if not keep.any():
+        return []
 
-    ranked = sorted(agg.items(), key=lambda x: x[1], reverse=True)
-    return ranked[:topn]
+    agg = np.bincount(codes[keep], weights=hits["scores"][keep], minlength=len(company_names))
+    cands = np.unique(codes[keep])
+    if len(cands) > topn:
+        cands = cands[np.argpartition(-agg[cands], topn)[:topn]]
+    cands = cands[np.argsort(-agg[cands], kind="stable")]
+    return [(company_names[k], float(agg[k])) for k in cands]
 
 
 def pick_company_passages(
-    results: List[Dict[str, Any]], company: str, limit: int = 5
+    hits: Dict[str, np.ndarray], company: str, limit: int = 5
 ) -> List[Dict[str, Any]]:
-    cands = [r for r in results if r.get("company") == company]
-    cands.sort(key=lambda x: x["score"], reverse=True)
-    return cands[:limit]
+    """只替被選中公司的前 limit 筆建立 passage dict"""
+    code = company_code_of.get(company)
+    if code is None:
+        return []
+
+    cands = select_hits(hits, company_codes[hits["meta_ids"]] == code)
+    order = np.argsort(-cands["scores"], kind="stable")[:limit]
+    return [build_passage(cands["meta_ids"][j], cands["scores"][j]) for j in order]
 
 
 def build_context(passages: List[Dict[str, Any]]) -> Tuple[str, Dict[int, Dict[str, Any]]]:
@@ -147,24 +204,33 @@ def build_context(passages: List[Dict[str, Any]]) -> Tuple[str, Dict[int, Dict[s
     return "\n".join(lines), cite_map
 
 
+def _is_claim_list(obj: Any) -> bool:
+    return isinstance(obj, list) and all(isinstance(x, dict) for x in obj)
+
+
 def safe_parse_json(text: str):
+    """解析 LLM 輸出的承諾清單；只接受 list of dict，否則回傳 None（交給修復呼叫）"""
     text = (text or "").strip()
 
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
+    parsed = loads_or_none(text)
+    if _is_claim_list(parsed):
+        return parsed
 
-    m = re.search(r"\[[\s\S]*\]", text)
-    if m:
-        try:
-            return json.loads(m.group(0))
-        except Exception:
-            return None
+    # 退而求其次：依序找 [ ... ] 區塊；前言裡的引用編號（例如 [294]）不是承諾清單，略過繼續找
+    for block in iter_balanced(text, "[", "]"):
+        parsed = loads_or_none(block)
+        if _is_claim_list(parsed):
+            return parsed
 
     return None
 
 
+def _json_array_complete(buf: str) -> bool:
+    """串流早停：整段輸出本身（從第一個非空白字元起）就是完整的 list of dict 才停；前言裡的 [294] 不算"""
+    s = buf.strip()
+    return s.startswith("[") and s.endswith("]") and _is_claim_list(loads_or_none(s))
+
+
 def enrich_claims_with_source_chunks(
     claims: List[Dict[str, Any]],
     cite_map: Dict[int, Dict[str, Any]],
@@ -211,11 +277,8 @@ def match_company_name(name: str, preferred: str) -> bool:
     優先以 normalized equality 為主（避免因為『台灣中油2024』或空白導致不同），若 equality 沒命中，
     則退回到包含關係做寬鬆比對作為最後手段。
     """
-    def norm(s: str) -> str:
-        return re.sub(r"\s+", "", s or "").lower()
-
-    n1 = norm(name)
-    n2 = norm(preferred)
+    n1 = norm_name(name)
+    n2 = norm_name(preferred)
     if not n1 or not n2:
         return False
     # 先嚴格比對（去空白小寫），再寬鬆包含
@@ -252,19 +315,32 @@ def choose_company(
 def ask_llm_extract_claims(selected_company: str, passages: List[Dict[str, Any]]):
     context, cite_map = build_context(passages)
 
+    # 固定前綴：system + 引用內容。第一次與修復呼叫完全相同，
+    # Ollama 可直接重用這段的 KV cache，修復時不必重新 prefill 整段 context。
+    prefix = [
+        {
+            "role": "system",
+            "content": "You are a strict JSON generator. Output ONLY a JSON array. No explanations.",
+        },
+        {
+            "role": "user",
+            "content": f"""
+【本次判斷的公司】
+{selected_company}
+
+【引用內容（僅可使用以下內容）】
+{context}
+""",
+        },
+    ]
+
     prompt = f"""
 【強制輸出格式】
 你只能輸出「JSON 陣列」且不得包含任何其他文字。
 若無明確承諾，請輸出 []。
 
 你是永續報告書的「承諾提取代理人（Agent A）」。
-你的任務是：只根據引用內容，抽取企業在環境/永續面向的承諾、目標、策略、路徑或政策宣示。
-
-【本次判斷的公司】
-{selected_company}
-
-【引用內容（僅可使用以下內容）】
-{context}
+你的任務是：只根據上面的引用內容，抽取 {selected_company} 在環境/永續面向的承諾、目標、策略、路徑或政策宣示。
 
 【輸出要求】
 1) 僅能根據引用內容，不可自行推測或補寫。
@@ -284,36 +360,24 @@ def ask_llm_extract_claims(selected_company: str, passages: List[Dict[str, Any]]
 請只輸出 JSON。
 """
 
-    # 第一次（強約束 + 低溫）
-    resp = ollama.chat(
-        model=LLM_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a strict JSON generator. Output ONLY a JSON array. No explanations.",
-            },
-            {"role": "user", "content": prompt},
-        ],
-        options={"temperature": 0},
-    )
-    raw = resp["message"]["content"].strip()
+    # 第一次（強約束 + 低溫）；串流中一出現完整 JSON 陣列就停止生成
+    raw = chat_until(
+        LLM_MODEL,
+        prefix + [{"role": "user", "content": prompt}],
+        LLM_OPTIONS,
+        is_done=_json_array_complete,
+    ).strip()
 
     if safe_parse_json(raw) is not None:
         return raw, cite_map
 
-    # 第二次：修復 JSON
+    # 第二次：修復 JSON（前綴不變，只換最後的指令）
     repair_prompt = f"""
 你剛才的輸出不是合法 JSON。
-請根據下列引用內容，重新輸出「只包含 JSON 陣列」的答案。
-
-【本次判斷的公司】
-{selected_company}
-
-【引用內容】
-{context}
+請根據上面的引用內容，重新輸出「只包含 JSON 陣列」的答案。
 
 【輸出欄位】
-- company
+- company（請填 {selected_company}）
 - claim_text
 - topic
 - target_year
@@ -324,18 +388,12 @@ def ask_llm_extract_claims(selected_company: str, passages: List[Dict[str, Any]]
 只能輸出 JSON 陣列。若無明確承諾，輸出 []。
 """
 
-    resp2 = ollama.chat(
-        model=LLM_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a strict JSON generator. Output ONLY a JSON array. No explanations.",
-            },
-            {"role": "user", "content": repair_prompt},
-        ],
-        options={"temperature": 0},
-    )
-    raw2 = resp2["message"]["content"].strip()
+    raw2 = chat_until(
+        LLM_MODEL,
+        prefix + [{"role": "user", "content": repair_prompt}],
+        LLM_OPTIONS,
+        is_done=_json_array_complete,
+    ).strip()
     return raw2, cite_map
 
 
@@ -347,35 +405,34 @@ def agent_a_extract_claims(query: str, preferred_company: Optional[str] = None):
     """
     print("[AgentA] 收到 query =", query, "| preferred_company =", preferred_company)
 
-    # 1) 全庫檢索
-    print("[AgentA] 開始 retrieve_all ...")
-    results = retrieve_all(query, topk=RETRIEVE_TOPK)
-    print(f"[AgentA] retrieve_all 完成，取回 {len(results)} 筆")
+    # 1) 全庫檢索（欄式結果，只有最後選中的 passages 才會建 dict）
+    print("[AgentA] 開始 retrieve_raw ...")
+    results = retrieve_raw(query, topk=RETRIEVE_TOPK)
+    print(f"[AgentA] retrieve_raw 完成，取回 {len(results['meta_ids'])} 筆")
 
-    if not results:
+    if not len(results["meta_ids"]):
         return {"ok": True, "selected_company": preferred_company, "claims": []}
 
     # === 2) 如果有指定公司，就先過濾掉別的公司 ===
     if preferred_company:
-        # 先嘗試嚴格 normalized equality（優先）
-        def _norm(s: str) -> str:
-            return re.sub(r"\s+", "", (s or "")).lower()
+        # 公司名只需比對一次（每家公司一個 code），再用 code 向量化過濾所有結果
+        codes = company_codes[results["meta_ids"]]
 
-        filtered_eq = [r for r in results if _norm(r.get("company", "")) == _norm(preferred_company)]
-        if filtered_eq:
-            filtered = filtered_eq
-            print(f"[AgentA] 使用嚴格 normalized 比對針對 {preferred_company} 過濾後剩 {len(filtered)} 筆")
+        # 先嘗試嚴格 normalized equality（優先）
+        preferred_norm = norm_name(preferred_company)
+        mask = np.isin(codes, [k for k, n in enumerate(company_names_norm) if n == preferred_norm])
+        if mask.any():
+            filtered = select_hits(results, mask)
+            print(f"[AgentA] 使用嚴格 normalized 比對針對 {preferred_company} 過濾後剩 {len(filtered['meta_ids'])} 筆")
         else:
             # fallback 到寬鬆包含比對（舊行為）
-            filtered = [
-                r
-                for r in results
-                if match_company_name(r.get("company", ""), preferred_company)
-            ]
-            print(f"[AgentA] 使用寬鬆比對針對 {preferred_company} 過濾後剩 {len(filtered)} 筆")
+            loose = [k for k, n in enumerate(company_names) if match_company_name(n, preferred_company)]
+            mask = np.isin(codes, loose)
+            filtered = select_hits(results, mask)
+            print(f"[AgentA] 使用寬鬆比對針對 {preferred_company} 過濾後剩 {len(filtered['meta_ids'])} 筆")
 
         # 完全沒有命中 -> 回傳「這家公司，但沒有找到承諾」
-        if not filtered:
+        if not len(filtered["meta_ids"]):
             return {
                 "ok": True,
                 "selected_company": preferred_company,
@@ -450,7 +507,7 @@ def agent_a_extract_claims(query: str, preferred_company: Optional[str] = None):
 if __name__ == "__main__":
     import sys
 
-    # 支援：python agents/agent_a.py 台塑 請問在永續報告書內有提到哪些罰款？
+    # 支援：python -m agents.agent_a 台塑 請問在永續報告書內有提到哪些罰款？
     if len(sys.argv) > 2:
         preferred = sys.argv[1]
         user_query = " ".join(sys.argv[2:])
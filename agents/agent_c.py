@@ -1,31 +1,41 @@
+import asyncio
 import json
 import re
 from pathlib import Path
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
 from urllib.parse import urlencode
+import aiohttp
 import feedparser
-from sentence_transformers import SentenceTransformer
-import ollama
+import numpy as np
+
+from agents._jsonutil import extract_balanced, loads_or_none
+from agents._llm import chat_until
+from agents._models import get_embedder
 
 
 # ===== 模型 =====
-EMB_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 LLM_MODEL = "llama3"  # 或你本機有的模型
 
-embedder = SentenceTransformer(EMB_MODEL)
+embedder = get_embedder()
 
 # ===== 參數 =====
 TOPK_FEEDS_PER_QUERY = 50
 EMB_FILTER_TOPK = 12
+EMB_RERANK_BATCH_SIZE = 32    # 小一點的 batch，長短新聞才會落在不同 batch
+RSS_TIMEOUT_SEC = 8
 
 # 你可自己擴充媒體 RSS
 GOOGLE_NEWS_RSS = "https://news.google.com/{query}&hl=zh-TW&gl=TW&ceid=TW:zh-Hant"
 
 
 # ===== 小工具 =====
+_WS_RE = re.compile(r"\s+")
+
+
 def normalize_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    return _WS_RE.sub(" ", (s or "")).strip()
 
 
 def build_queries(company: str) -> List[str]:
@@ -40,7 +50,7 @@ def build_queries(company: str) -> List[str]:
     ]
 
 
-def fetch_google_rss(query: str, limit: int = 10):
+async def fetch_google_rss(session: aiohttp.ClientSession, query: str, limit: int = 10):
     base = "https://news.google.com/rss/search"
 
     params = {
@@ -52,7 +62,13 @@ def fetch_google_rss(query: str, limit: int = 10):
 
     url = f"{base}?{urlencode(params)}"
 
-    feed = feedparser.parse(url)
+    try:
+        async with session.get(url) as resp:
+            body = await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return []
+
+    feed = feedparser.parse(body)
 
     items = []
     for e in feed.entries[:limit]:
@@ -67,7 +83,16 @@ def fetch_google_rss(query: str, limit: int = 10):
     return items
 
 
+async def fetch_all_rss(queries: List[str], limit: int = 10) -> List[List[Dict[str, Any]]]:
+    """共用一個 session，同時抓所有 query 的 RSS（結果順序與 queries 相同）"""
+    timeout = aiohttp.ClientTimeout(total=RSS_TIMEOUT_SEC)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        return await asyncio.gather(*[fetch_google_rss(session, q, limit=limit) for q in queries])
+
+
+@lru_cache(maxsize=2048)
 def parse_date_safe(published_str: str) -> Optional[str]:
+    """同一批 RSS 常有重複的發布時間字串，解析結果直接快取"""
     if not published_str:
         return None
     # Google RSS 常見格式可直接嘗試解析
@@ -90,24 +115,44 @@ def dedup_news(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return out
 
 
+@lru_cache(maxsize=256)
+def _company_query_emb(company: str):
+    """rerank 用的 query 向量只跟公司有關，同一家公司重複查詢時直接用快取"""
+    query = f"{company} 環境 永續 負面事件 裁罰 污染"
+    return embedder.encode([query], normalize_embeddings=True, show_progress_bar=False)[0]
+
+
 def emb_rerank(company: str, items: List[Dict[str, Any]], topk: int = 10) -> List[Dict[str, Any]]:
     if not items:
         return []
 
-    query = f"{company} 環境 永續 負面事件 裁罰 污染"
     texts = [f"{it.get('title','')} {it.get('summary','')}" for it in items]
 
-    q_emb = embedder.encode([query], normalize_embeddings=True)
-    d_emb = embedder.encode(texts, normalize_embeddings=True)
+    q_emb = _company_query_emb(company)
+
+    # 依長度排序後再 encode，讓同一個 batch 的長度接近、少補 padding；最後還原順序
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    embs = embedder.encode(
+        [texts[i] for i in order],
+        batch_size=EMB_RERANK_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    d_emb = np.empty_like(embs)
+    d_emb[order] = embs
 
-    # cosine via dot
-    scores = (d_emb @ q_emb[0]).tolist()
+    # cosine via dot；只對 topk 做排序
+    scores = d_emb @ q_emb
+    idx = np.arange(len(scores))
+    if topk < len(scores):
+        idx = np.argpartition(-scores, topk)[:topk]
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
 
-    ranked = sorted(zip(items, scores), key=lambda x: x[1], reverse=True)[:topk]
     out = []
-    for it, s in ranked:
-        it = dict(it)
-        it["relevance_score"] = float(s)
+    for i in idx:
+        it = dict(items[i])
+        it["relevance_score"] = float(scores[i])
         it["event_date_guess"] = parse_date_safe(it.get("published", "")) or None
         out.append(it)
     return out
@@ -115,20 +160,22 @@ def emb_rerank(company: str, items: List[Dict[str, Any]], topk: int = 10) -> Lis
 
 def safe_parse_json(text: str):
     text = (text or "").strip()
-    try:
-        return json.loads(text)
-    except:
-        pass
-
-    m = re.search(r"\{[\s\S]*\}$", text)
-    if m:
-        try:
-            return json.loads(m.group(0))
-        except:
-            return None
+    parsed = loads_or_none(text)
+    if parsed is not None:
+        return parsed
+
+    block = extract_balanced(text, "{", "}")
+    if block:
+        return loads_or_none(block)
     return None
 
 
+def _json_object_complete(buf: str) -> bool:
+    """串流早停：整段輸出本身（從第一個非空白字元起）就是完整的 JSON 物件才停"""
+    s = buf.strip()
+    return s.startswith("{") and s.endswith("}") and isinstance(loads_or_none(s), dict)
+
+
 def ask_llm_extract_events(company: str, news_items: List[Dict[str, Any]]) -> Dict[str, Any]:
     # 給 LLM 的引用上下文（用編號）
     lines = []
@@ -178,16 +225,16 @@ def ask_llm_extract_events(company: str, news_items: List[Dict[str, Any]]) -> Di
 3) topic/severity 請保守判斷。
 """
 
-    resp = ollama.chat(
-        model=LLM_MODEL,
-        messages=[
+    # 串流中一出現完整 JSON 物件就停止生成
+    raw = chat_until(
+        LLM_MODEL,
+        [
             {"role": "system", "content": "You are a strict JSON generator. Output ONLY JSON."},
             {"role": "user", "content": prompt}
         ],
-        options={"temperature": 0}
+        {"temperature": 0},
+        is_done=_json_object_complete,
     )
-
-    raw = resp["message"]["content"]
     parsed = safe_parse_json(raw)
     if parsed is not None:
         return parsed
@@ -226,10 +273,10 @@ def agent_c(company: str) -> Dict[str, Any]:
     # 1) build queries
     queries = build_queries(company)
 
-    # 2) fetch rss
+    # 2) fetch rss（並行）
     all_items = []
-    for q in queries:
-        all_items.extend(fetch_google_rss(q, limit=TOPK_FEEDS_PER_QUERY))
+    for items in asyncio.run(fetch_all_rss(queries, limit=TOPK_FEEDS_PER_QUERY)):
+        all_items.extend(items)
 
     all_items = dedup_news(all_items)
 
@@ -1,7 +1,8 @@
 # agent_d.py
 import json
-from typing import Dict, Any, List
-import ollama
+from typing import Dict, Any, Iterator, List
+
+from agents._llm import stream_chat
 
 LLM_MODEL = "llama3"  # 或你在用的 qwen2.5:7b 等
 
@@ -40,33 +41,30 @@ def build_news_brief(agent_c: Dict[str, Any], limit: int = 30) -> List[Dict[str,
         })
     return out
 
-def agent_d_judge(query: str, agent_a: Dict[str, Any], agent_c: Dict[str, Any]) -> str:
-    """
-    Agent D：不再回傳 JSON，而是「給使用者看的文字敘述」。
-    這段文字會直接給前端顯示。
-    """
+def build_judge_messages(query: str, agent_a: Dict[str, Any], agent_c: Dict[str, Any]) -> List[Dict[str, str]]:
     company = agent_a.get("selected_company") or agent_c.get("selected_company") or "目標公司"
 
     claims_brief = build_claim_brief(agent_a)
     news_brief = build_news_brief(agent_c)
 
+    # 變動最大的使用者問題放在最後，前面的摘要可共用 Ollama 的 KV cache
     prompt = f"""
 你是「Agent D：漂綠判讀與說明代理人」。
 你的任務是：整合永續報告中的承諾（Agent A）以及外部新聞／爭議（Agent C），
 用**繁體中文**寫出一份「給一般使用者看的」分析說明，幫助使用者判斷是否有漂綠風險。
 
-【使用者原始問題】
-{query}
-
-【推定公司】
-{company}
-
 【Agent A：永續報告承諾摘要（JSON，請閱讀後自行整理重點，不要原文貼過來）】
 {json.dumps(claims_brief, ensure_ascii=False)}
 
 【Agent C：外部新聞與爭議摘要（JSON，請閱讀後自行整理重點，不要全部貼出）】
 {json.dumps(news_brief, ensure_ascii=False)}
 
+【推定公司】
+{company}
+
+【使用者原始問題】
+{query}
+
 請依照下列結構輸出一段「連續文字＋條列」的說明，不要輸出 JSON，不要加任何系統提示：
 
 一、問題與公司重述
@@ -96,17 +94,25 @@ def agent_d_judge(query: str, agent_a: Dict[str, Any], agent_c: Dict[str, Any])
 - 不要輸出 JSON，也不要出現任何類似 {{...}} 或 [] 的結構。
 """
 
-    resp = ollama.chat(
-        model=LLM_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": "你是一名嚴謹的永續報告與媒體內容分析專家，會用清楚、有結構的繁體中文寫作。"
-            },
-            {"role": "user", "content": prompt},
-        ],
-        options={"temperature": 0.2}
-    )
-
-    final_text = resp["message"]["content"].strip()
+    return [
+        {
+            "role": "system",
+            "content": "你是一名嚴謹的永續報告與媒體內容分析專家，會用清楚、有結構的繁體中文寫作。"
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+def agent_d_judge_stream(query: str, agent_a: Dict[str, Any], agent_c: Dict[str, Any]) -> Iterator[str]:
+    """
+    Agent D 串流版：逐段 yield 給使用者看的文字，前端可邊生成邊顯示。
+    """
+    messages = build_judge_messages(query, agent_a, agent_c)
+    yield from stream_chat(LLM_MODEL, messages, {"temperature": 0.2})
+
+def agent_d_judge(query: str, agent_a: Dict[str, Any], agent_c: Dict[str, Any]) -> str:
+    """
+    Agent D：不再回傳 JSON，而是「給使用者看的文字敘述」。
+    這段文字會直接給前端顯示。
+    """
+    final_text = "".join(agent_d_judge_stream(query, agent_a, agent_c)).strip()
     return final_text
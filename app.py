@@ -1,6 +1,9 @@
 # app.py
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from pathlib import Path
@@ -8,7 +11,8 @@ import json
 
 from agents.agent_a import agent_a_extract_claims
 from agents.agent_c import agent_c
-from agents.agent_d import agent_d_judge  # Agent D：最後的綜合判讀
+from agents.agent_d import agent_d_judge, agent_d_judge_stream  # Agent D：最後的綜合判讀
+from agents._models import get_meta as load_meta
 
 
 # ---------- FastAPI 基本設定 ----------
@@ -36,34 +40,52 @@ def health():
 
 
 # ---------- 主流程：同時呼叫 A / C / D ----------
+async def run_agents_a_c(company: str, query: str):
+    """
+    同時執行 Agent A（承諾抽取）與 Agent C（新聞），回傳 (a_result, c_result)。
+    兩者沒有資料相依，各自丟到 thread pool，總耗時 ≈ max(A, C)。
+    """
+    loop = asyncio.get_running_loop()
+
+    # 1) Agent A：查詢時把公司名一起丟進去，提升命中率
+    a_task = loop.run_in_executor(
+        None,
+        lambda: agent_a_extract_claims(
+            query=f"{company} {query}",
+            preferred_company=company,
+        ),
+    )
+
+    # 2) Agent C：用公司名去抓 Google News RSS
+    c_task = loop.run_in_executor(None, lambda: agent_c(company))
+
+    a_result, c_result = await asyncio.gather(a_task, c_task)
+    return a_result, c_result
+
+
 @app.post("/run")
-def run_all(payload: RunInput):
+async def run_all(payload: RunInput):
     """
     前端按下「送出查詢」後會呼叫這裡。
 
-    這裡會依序呼叫：
+    這裡會呼叫：
     - Agent A：永續報告承諾抽取（向量 DB + LLM）
-    - Agent C：外部負面新聞爬蟲（Google News RSS）
-    - Agent D：綜合判讀，輸出給使用者看的自然語言說明
+    - Agent C：外部負面新聞爬蟲（Google News RSS）（與 A 同時執行）
+    - Agent D：綜合判讀，輸出給使用者看的自然語言說明（等 A / C 都完成後）
     """
     company = (payload.company or "").strip()
     query = (payload.query or "").strip()
 
-    # 1) Agent A：查詢時把公司名一起丟進去，提升命中率
-    a_query = f"{company} {query}".strip()
-    a_result = agent_a_extract_claims(
-    query=f"{company} {query}",
-    preferred_company=company,
-)
-
-    # 2) Agent C：用公司名去抓 Google News RSS
-    c_result = agent_c(company)
+    a_result, c_result = await run_agents_a_c(company, query)
 
     # 3) Agent D：產出給使用者看的文字說明（不需再遵守 JSON 格式）
-    d_text = agent_d_judge(
-        query=f"{company}：{query}".strip("："),
-        agent_a=a_result,
-        agent_c=c_result,
+    d_text = await asyncio.get_running_loop().run_in_executor(
+        None,
+        lambda: agent_d_judge(
+            query=f"{company}：{query}".strip("："),
+            agent_a=a_result,
+            agent_c=c_result,
+        ),
     )
 
     return {
@@ -75,6 +97,31 @@ def run_all(payload: RunInput):
     }
 
 
+@app.post("/run/stream")
+async def run_all_stream(payload: RunInput):
+    """
+    與 /run 相同，但 Agent D 的文字改為串流回傳（NDJSON，一行一個 JSON）：
+    - 第一行：{"company", "query", "agent_a", "agent_c"}
+    - 之後每行：{"agent_d_delta": "..."}，依序串起來就是 agent_d_text
+    """
+    company = (payload.company or "").strip()
+    query = (payload.query or "").strip()
+
+    a_result, c_result = await run_agents_a_c(company, query)
+
+    def events():
+        head = {"company": company, "query": query, "agent_a": a_result, "agent_c": c_result}
+        yield json.dumps(head, ensure_ascii=False) + "\n"
+        for delta in agent_d_judge_stream(
+            query=f"{company}：{query}".strip("："),
+            agent_a=a_result,
+            agent_c=c_result,
+        ):
+            yield json.dumps({"agent_d_delta": delta}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
 @app.get("/companies")
 def get_companies():
     """回傳後端 canonical companies 清單，供前端選單使用。"""
@@ -87,25 +134,23 @@ def get_companies():
 
 @app.get("/meta/{meta_id}")
 def get_meta(meta_id: int):
-    """回傳指定 meta_id 的一筆 meta（index_out/meta.json 以 list 儲存，meta_id 對應 index）。"""
-    p = Path("index_out") / "meta.json"
+    """回傳指定 meta_id 的一筆 meta（index_out/meta.parquet 的 row index 即 meta_id）。"""
     try:
-        arr = json.loads(p.read_text(encoding="utf-8"))
+        meta = load_meta()
     except Exception:
         return {}
 
-    if meta_id < 0 or meta_id >= len(arr):
+    if meta_id < 0 or meta_id >= meta.num_rows:
         return {}
 
-    return arr[meta_id]
+    return meta.slice(meta_id, 1).to_pylist()[0]
 
 
 @app.get("/meta")
 def get_meta_batch(ids: str = ""):
     """批次取得多筆 meta，透過 query ?ids=1,2,3"""
-    p = Path("index_out") / "meta.json"
     try:
-        arr = json.loads(p.read_text(encoding="utf-8"))
+        meta = load_meta()
     except Exception:
         return []
 
@@ -119,12 +164,11 @@ def get_meta_batch(ids: str = ""):
         except Exception:
             continue
 
-    out = []
-    for i in id_list:
-        if 0 <= i < len(arr):
-            out.append(arr[i])
+    valid = [i for i in id_list if 0 <= i < meta.num_rows]
+    if not valid:
+        return []
 
-    return out
+    return meta.take(valid).to_pylist()
 
 
 # ---------- 靜態檔案（前端頁面） ----------
@@ -1,29 +1,21 @@
-import json
-from pathlib import Path
-import pandas as pd
 import faiss
-from sentence_transformers import SentenceTransformer
 
-OUT_DIR = Path("index_out") 
-MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+from chunks import OUT_DIR, build_index, encode_texts, load_model, read_chunks_csv, write_meta
 
 chunks_csv = OUT_DIR / "chunks.csv"
-meta_json = OUT_DIR / "meta.json"
 
-df = pd.read_csv(chunks_csv)
-texts = df["chunk"].tolist()
+df = read_chunks_csv(chunks_csv)
+# 直接交給 encode_texts 的 object array，不另外建一份 Python list
+texts = df["chunk"].to_numpy(dtype=object)
 
-model = SentenceTransformer(MODEL_NAME)
-emb = model.encode(texts, batch_size=64, show_progress_bar=True, normalize_embeddings=True)
+model = load_model()
+emb = encode_texts(model, texts)
 
-dim = emb.shape[1]
-index = faiss.IndexFlatIP(dim)
-index.add(emb)
+index = build_index(emb, df["vec_id"].to_numpy(dtype="int64"))
 
 faiss.write_index(index, str(OUT_DIR / "faiss.index"))
 
-meta = df.to_dict(orient="records")
-meta_json.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+write_meta(df)
 
 print("done -> faiss.index")
 print("chunks:", len(df))
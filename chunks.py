@@ -1,25 +1,75 @@
+import csv
+import hashlib
+import os
 import re
 import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
 from pathlib import Path
 import fitz
+import numpy as np
 import pandas as pd
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
 
+from agents._models import EMB_BACKEND, EMB_ONNX_FILE
+
 DATA_DIR = Path("data")
 OUT_DIR = Path("index_out")
-OUT_DIR.mkdir(exist_ok=True)
 
 MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-model = SentenceTransformer(MODEL_NAME)
+
+# 滑動視窗：3 句一個 chunk，每次前進 2 句（相鄰 chunk 仍重疊 1 句）
+CHUNK_WINDOW = 3
+CHUNK_STRIDE = 2
+
+# chunks.csv / meta 的欄位（順序即 CSV 欄位順序）
+CSV_DTYPES = {
+    "company": "string",
+    "company_id": "string",
+    "year": "Int64",
+    "source_stem": "string",
+    "pdf": "string",
+    "page": "Int64",
+    "vec_id": "Int64",
+    "chunk": "string",
+}
+
+# CPU 上平行 encode 的 process 數（1 = 單一 process；多張 GPU 時會自動每張卡一個 process）
+ENCODE_PROCESSES = int(os.getenv("ENCODE_PROCESSES", "1"))
+
+# index 類型：auto（預設，依資料量選 IVF-PQ / SQ8）/ hnsw / fp16（半精度 flat）/ flat（精確搜尋，當 ground truth 用）
+INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+
+# IVF-PQ 參數：每個向量壓成 PQ_M bytes；資料量太少時無法訓練，退回 SQ8
+PQ_M = 16
+PQ_NBITS = 8
+IVF_MIN_POINTS_PER_LIST = 39  # FAISS 建議每個 centroid 至少 39 筆訓練資料
+IVF_MIN_NLIST = 64
+IVF_MAX_NPROBE = 16
+
+# 舊版 meta.json 相容：設 META_JSON=1 時另外匯出一份 records 格式的 meta.json
+META_JSON = os.getenv("META_JSON", "0") == "1"
+
+# HNSW 參數（查詢端的 efSearch 在 agents/_models.py 設定）
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+
+_WS_RE = re.compile(r"\s+")
+_SENT_SPLIT_RE = re.compile(r"[。；！？]")
+_USCORE_DASH_RE = re.compile(r"[_\-]+")
 
 def normalize_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", s).strip()
+    return _WS_RE.sub(" ", s).strip()
 
 
+@lru_cache(maxsize=4096)
 def norm_company(s: str) -> str:
     """簡單 normalize：去空白、小寫，供比對使用"""
-    return re.sub(r"\s+", "", (s or "")).strip().lower()
+    return _WS_RE.sub("", (s or "")).strip().lower()
 
 
 def load_companies(path: Path = DATA_DIR / "companies.json"):
@@ -30,19 +80,119 @@ def load_companies(path: Path = DATA_DIR / "companies.json"):
 
 def split_sentences(text: str):
     text = normalize_ws(text)
-    sents = re.split(r"[。；！？]", text)
+    sents = _SENT_SPLIT_RE.split(text)
     return [s.strip() for s in sents if s.strip()]
 
-def make_chunks(sents, window=3, stride=1):
+def make_chunks(sents, window=3, stride=2):
+    starts = list(range(0, max(0, len(sents) - window + 1), stride))
+    # stride > 1 時補上最後一個視窗，確保頁尾的句子也有被涵蓋
+    if starts and starts[-1] != len(sents) - window:
+        starts.append(len(sents) - window)
+
+    # 整頁只串接一次：每句後面接「。」，offsets[k] 是第 k 句在 joined 的起點，
+    # 視窗 i 的 chunk 就是 joined[offsets[i]:offsets[i+window]]（結尾已含「。」）。
+    # sents 已經過 normalize_ws 且各自 strip，用「。」串接不會產生新的空白
+    joined = "。".join(sents) + "。"
+    offsets = [0, *accumulate(len(s) + 1 for s in sents)]
+
     chunks = []
-    for i in range(0, max(0, len(sents) - window + 1), stride):
-        chunk = "。".join(sents[i:i+window]) + "。"
-        chunk = normalize_ws(chunk)
-        if 50 <= len(chunk) <= 800:
-            chunks.append(chunk)
+    for i in starts:
+        start, end = offsets[i], offsets[i + window]
+        if 50 <= end - start <= 800:
+            chunks.append(joined[start:end])
     return chunks
 
-YEAR_4_RE = re.compile(r"(?:19|20)\d{2}")  # 1900~2099
+def load_model():
+    """
+    有 CUDA 就放 GPU 並轉 FP16（向量最後會再 normalize，精度損失對內積檢索無影響）。
+    EMB_BACKEND=onnx 時改用 ONNX Runtime（可搭配 EMB_ONNX_FILE 指定 int8 量化模型），
+    與 Agent 查詢端（agents/_models.py）使用同一組設定，兩邊的向量才一致。
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if EMB_BACKEND == "onnx":
+        model_kwargs = {"file_name": EMB_ONNX_FILE} if EMB_ONNX_FILE else None
+        return SentenceTransformer(MODEL_NAME, device=device, backend="onnx", model_kwargs=model_kwargs)
+
+    model = SentenceTransformer(MODEL_NAME, device=device)
+    if device == "cuda":
+        model.half()
+    return model
+
+def encode_targets():
+    """多 process encode 的裝置清單；只有單一裝置時回傳 None（直接 model.encode）"""
+    if torch.cuda.device_count() > 1:
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    if ENCODE_PROCESSES > 1:
+        return ["cpu"] * ENCODE_PROCESSES
+    return None
+
+def encode_texts(model, texts):
+    """
+    把 chunks 編碼成正規化向量（row 與 texts 對齊）。
+    報告書常有重複的頁首/頁尾/聲明，相同字串只 encode 一次再展開回原順序；
+    encode 前依長度排序，減少 batch 內的 padding。
+    """
+    unique, inverse = np.unique(np.asarray(texts, dtype=object), return_inverse=True)
+
+    # 依長度排序後 encode，同一 batch 長度接近、padding 最少；再放回 unique 的順序
+    order = np.argsort([len(t) for t in unique], kind="stable")
+    targets = encode_targets()
+    if targets:
+        pool = model.start_multi_process_pool(targets)
+        try:
+            sorted_emb = model.encode_multi_process(unique[order].tolist(), pool, batch_size=64)
+        finally:
+            model.stop_multi_process_pool(pool)
+        sorted_emb = np.asarray(sorted_emb, dtype=np.float32)
+        sorted_emb /= np.linalg.norm(sorted_emb, axis=1, keepdims=True)
+    else:
+        sorted_emb = model.encode(
+            unique[order].tolist(), batch_size=64, show_progress_bar=True, normalize_embeddings=True
+        )
+        sorted_emb = np.asarray(sorted_emb, dtype=np.float32)  # FP16 模型輸出轉回 FAISS 要的 float32
+    unique_emb = np.empty_like(sorted_emb)
+    unique_emb[order] = sorted_emb
+    return unique_emb[inverse.reshape(-1)]
+
+def build_index(emb, ids):
+    """
+    建立內積（= cosine）index：
+      - hnsw：IndexHNSWFlat，查詢約 O(log N)
+      - flat：IndexFlatIP，暴力精確搜尋
+      - fp16：每維存成 FP16 的 flat 掃描，記憶體減半、結果幾乎與 flat 相同
+      - auto：依資料量建立 IVF-PQ，太小的語料庫退回 SQ8（每維 1 byte 的 flat 掃描）
+    外層包 IndexIDMap2：每個向量帶 meta 的 vec_id，搜尋回傳 vec_id 而不是 row 位置。
+    """
+    n, dim = emb.shape
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(np.unique(ids)) != n:
+        raise ValueError("vec_id 重複，無法建立 IDMap")
+
+    if INDEX_TYPE == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif INDEX_TYPE == "fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif INDEX_TYPE == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    else:
+        nlist = max(int(math.sqrt(n)), IVF_MIN_NLIST)
+        # IVF 的 nlist 個 centroid 與 PQ 每個子空間的 2^nbits 個 centroid 都要足夠的訓練資料
+        if n < max(nlist, 2 ** PQ_NBITS) * IVF_MIN_POINTS_PER_LIST or dim % PQ_M:
+            index = faiss.index_factory(dim, "SQ8", faiss.METRIC_INNER_PRODUCT)
+        else:
+            quant = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quant, dim, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+            index.nprobe = min(nlist // 4, IVF_MAX_NPROBE)  # 會一起寫進 index 檔
+
+    if not index.is_trained:
+        index.train(emb)
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(emb, ids)
+    return index
+
+# 1900~2099；pattern 沒有回溯問題，維持標準 re（RE2 的 \d / \s 只認 ASCII，行為會不同）
+YEAR_4_RE = re.compile(r"(?:19|20)\d{2}")
 
 def extract_year_from_text(s: str):
     m = YEAR_4_RE.search(s)
@@ -60,26 +210,29 @@ def parse_company_year_from_filename(stem: str):
     if year is not None:
         company = company.replace(str(year), "")
 
-    company = re.sub(r"[_\-]+", " ", company)      # _ - 變空白
-    company = re.sub(r"\s+", " ", company).strip() # 多空白收斂
+    company = _USCORE_DASH_RE.sub(" ", company)    # _ - 變空白
+    company = _WS_RE.sub(" ", company).strip()     # 多空白收斂
 
     return company, year
 
 def guess_year_from_pdf_first_page(doc: fitz.Document):
     if len(doc) == 0:
         return None
-    t = doc[0].get_text("text", sort=True)
-    t = normalize_ws(t)
-    return extract_year_from_text(t)
+    # 年份比對不受空白影響，直接在原始文字上找，不必先跑一次 normalize_ws
+    return extract_year_from_text(doc[0].get_text("text"))
 
-records = []
+# 載入 canonical companies（由後端/資料提供）；放在模組層級，worker process 也拿得到
+COMPANIES = load_companies()
 
-pdfs = sorted(DATA_DIR.glob("*.pdf"))
-if not pdfs:
-    raise FileNotFoundError("data/ 資料夾沒有 PDF")
+# norm_company(value) -> (canonical_value, company_id)，精準比對 O(1)
+COMPANY_INDEX = {}
+for _c in COMPANIES:
+    _v = _c.get("value") or _c.get("label")
+    if _v:
+        COMPANY_INDEX.setdefault(norm_company(_v), (_v, _c.get("id") or _v))
 
-# 載入 canonical companies（由後端/資料提供）
-COMPANIES = load_companies()
+# 包含比對用：(nv, len(nv), hit)，保留 companies.json 的順序（先符合者優先）
+COMPANY_SUBSTR = [(nv, len(nv), hit) for nv, hit in COMPANY_INDEX.items()]
 
 def canonicalize_company(parsed: str):
     """嘗試把 parsed company 對齊到 companies.json 裡的 canonical value。
@@ -89,63 +242,198 @@ def canonicalize_company(parsed: str):
         return parsed, None
 
     n = norm_company(parsed)
-    # 精準比對 -> 包含關係
-    for c in COMPANIES:
-        v = c.get("value") or c.get("label")
-        if not v:
-            continue
-        nv = norm_company(v)
-        if nv == n or nv in n or n in nv:
-            return v, c.get("id") or v
+    # 精準比對（查表）
+    hit = COMPANY_INDEX.get(n)
+    if hit:
+        return hit
+
+    # 包含關係：長度決定只可能是哪個方向包含，每筆最多做一次子字串比對
+    ln = len(n)
+    for nv, lv, hit in COMPANY_SUBSTR:
+        if lv < ln:
+            if nv in n:
+                return hit
+        elif lv > ln and n in nv:
+            return hit
 
     # 找不到就回原始 parsed
     return parsed, None
 
-for pdf_path in pdfs:
+
+def chunk_vec_id(pdf: str, page: int, idx: int) -> int:
+    """(pdf, 頁碼, 頁內 chunk 序號) -> 穩定的 63-bit id（內建 hash() 每個 process 不同，不能用）"""
+    h = hashlib.blake2b(f"{pdf}|{page}|{idx}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(h, "little") & ((1 << 63) - 1)
+
+
+def process_pdf(pdf_path: Path):
+    """單一 PDF -> chunk records（在 worker process 裡執行）"""
     stem = pdf_path.stem
     company, year = parse_company_year_from_filename(stem)
+    canonical, cid = canonicalize_company(company)  # 只跟檔名有關，每個 PDF 算一次
 
-    doc = fitz.open(str(pdf_path))
-    if year is None:
-        year = guess_year_from_pdf_first_page(doc)
-
-    for pno, page in enumerate(doc, start=1):
-        text = page.get_text("text", sort=True)
-        text = normalize_ws(text)
-        if not text:
-            continue
-
-        sents = split_sentences(text)
-        chunks = make_chunks(sents, window=3, stride=1)
-
-        for c in chunks:
-            canonical, cid = canonicalize_company(company)
-            records.append({
-                "company": canonical,       # ✅ canonical（來自 companies.json）或 parsed
-                "company_id": cid,          # 可為 None
-                "year": year,               # ✅ 年分（可能為 None）
-                "source_stem": stem,        # ✅ 原始檔名（方便追溯）
-                "pdf": str(pdf_path),
-                "page": pno,
-                "chunk": c
-            })
-
-df = pd.DataFrame(records)
-df.to_csv(OUT_DIR / "chunks.csv", index=False, encoding="utf-8-sig")
-
-# embeddings
-texts = df["chunk"].tolist()
-emb = model.encode(texts, batch_size=64, show_progress_bar=True, normalize_embeddings=True)
-
-dim = emb.shape[1]
-index = faiss.IndexFlatIP(dim)
-index.add(emb)
-
-faiss.write_index(index, str(OUT_DIR / "faiss.index"))
-
-with open(OUT_DIR / "meta.json", "w", encoding="utf-8") as f:
-    json.dump(df.to_dict(orient="records"), f, ensure_ascii=False, indent=2)
-
-print("done")
-print("chunks:", len(df))
-print("index saved to:", OUT_DIR)
+    records = []
+    doc = fitz.open(pdf_path)
+    try:
+        if year is None:
+            year = guess_year_from_pdf_first_page(doc)
+
+        for pno, page in enumerate(doc, start=1):
+            # 不用 sort=True：多欄排版時它會把左右欄逐行交錯，原始順序反而是正確的閱讀順序
+            # NUL（未對應字型的 glyph）會讓 pandas 讀 chunks.csv 時把該欄截斷，先拿掉
+            text = page.get_text("text").replace("\x00", "")
+            text = normalize_ws(text)
+            if not text:
+                continue
+
+            sents = split_sentences(text)
+            chunks = make_chunks(sents, window=CHUNK_WINDOW, stride=CHUNK_STRIDE)
+
+            for ci, c in enumerate(chunks):
+                records.append({
+                    "company": canonical,       # ✅ canonical（來自 companies.json）或 parsed
+                    "company_id": cid,          # 可為 None
+                    "year": year,               # ✅ 年分（可能為 None）
+                    "source_stem": stem,        # ✅ 原始檔名（方便追溯）
+                    "pdf": str(pdf_path),
+                    "page": pno,
+                    "vec_id": chunk_vec_id(str(pdf_path), pno, ci),
+                    "chunk": c
+                })
+    finally:
+        doc.close()
+    return records
+
+
+def read_chunks_csv(path: Path = OUT_DIR / "chunks.csv") -> pd.DataFrame:
+    """讀回 chunks.csv；空欄位（company_id / year 可能為 None）讀成 null 而不是 NaN"""
+    return pd.read_csv(path, encoding="utf-8-sig", dtype=CSV_DTYPES)
+
+
+def df_records(df: pd.DataFrame):
+    """DataFrame -> list[dict]，pd.NA 轉成 None（寫 CSV / JSON 用）"""
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def write_meta(df: pd.DataFrame, out_dir: Path = OUT_DIR):
+    """meta 以 zstd 壓縮的 Parquet 儲存；需要時才額外轉出舊格式 meta.json"""
+    df.to_parquet(out_dir / "meta.parquet", compression="zstd", index=False)
+    if META_JSON:
+        with open(out_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(df_records(df), f, ensure_ascii=False, indent=2)
+
+
+def pdf_fingerprint(pdf_path: Path):
+    """判斷 PDF 有沒有變動：mtime、檔案大小、前 1MB 的 sha1"""
+    st = pdf_path.stat()
+    with open(pdf_path, "rb") as f:
+        head = hashlib.sha1(f.read(1 << 20)).hexdigest()
+    return {"mtime": st.st_mtime, "size": st.st_size, "sha1": head}
+
+
+def build_config():
+    """會影響 chunk / 向量內容的設定；任一項不同就整批重建"""
+    companies = json.dumps(COMPANIES, ensure_ascii=False, sort_keys=True)
+    return {
+        "model": MODEL_NAME,
+        "emb_backend": EMB_BACKEND,
+        "emb_onnx_file": EMB_ONNX_FILE,
+        "chunk_window": CHUNK_WINDOW,
+        "chunk_stride": CHUNK_STRIDE,
+        "csv_columns": list(CSV_DTYPES),
+        "companies_sha1": hashlib.sha1(companies.encode("utf-8")).hexdigest(),
+    }
+
+
+def load_cache():
+    """
+    讀上一次建索引留下的 manifest.json / chunks.csv / emb.npy。
+    回傳 (manifest["pdfs"], df, emb)；檔案不齊、設定不同或筆數對不上時回傳 None（整批重建）。
+    """
+    paths = [OUT_DIR / "manifest.json", OUT_DIR / "chunks.csv", OUT_DIR / "emb.npy"]
+    if not all(p.exists() for p in paths):
+        return None
+    manifest = json.loads(paths[0].read_text(encoding="utf-8"))
+    if manifest.get("config") != build_config():
+        return None
+    df = read_chunks_csv(paths[1])
+    emb = np.load(paths[2]).astype(np.float16, copy=False)
+    if len(df) != len(emb):
+        return None
+    return manifest["pdfs"], df, emb
+
+
+def main():
+    OUT_DIR.mkdir(exist_ok=True)
+
+    pdfs = sorted(DATA_DIR.glob("*.pdf"))
+    if not pdfs:
+        raise FileNotFoundError("data/ 資料夾沒有 PDF")
+
+    # 增量建置：PDF 沒變（manifest 記錄的 fingerprint 相同）就沿用上次的 rows 與 embeddings
+    old_pdfs, old_df, old_emb = load_cache() or ({}, None, None)
+    fingerprints = {str(p): pdf_fingerprint(p) for p in pdfs}
+    reused = {
+        k: old_pdfs[k] for k, fp in fingerprints.items()
+        if k in old_pdfs and all(old_pdfs[k][f] == fp[f] for f in fp)
+    }
+    todo = [p for p in pdfs if str(p) not in reused]
+
+    # chunks.csv 改寫到一半時 manifest 已不可信，先刪掉
+    (OUT_DIR / "manifest.json").unlink(missing_ok=True)
+
+    # 要重新解析的 PDF 平行處理；結果依 pdfs 順序與沿用的 rows 一起直接寫進 CSV
+    manifest_pdfs = {}
+    parts = []      # 每個 PDF 的 embedding 來源：("old", start, end) 或 ("new", start, end)
+    new_texts = []
+    n_rows = 0
+    with open(OUT_DIR / "chunks.csv", "w", newline="", encoding="utf-8-sig") as f_csv:
+        writer = csv.DictWriter(f_csv, fieldnames=list(CSV_DTYPES))
+        writer.writeheader()
+        # worker 數不超過 PDF 數，避免多開用不到的 process（每個都要 import 一次模組）
+        with ProcessPoolExecutor(max_workers=max(min(len(todo), os.cpu_count() or 1), 1)) as ex:
+            results = ex.map(process_pdf, todo)
+            for pdf in pdfs:
+                key = str(pdf)
+                if key in reused:
+                    start, end = reused[key]["start"], reused[key]["end"]
+                    writer.writerows(df_records(old_df.iloc[start:end]))
+                    parts.append(("old", start, end))
+                    count = end - start
+                else:
+                    recs = next(results)
+                    writer.writerows(recs)
+                    parts.append(("new", len(new_texts), len(new_texts) + len(recs)))
+                    new_texts.extend(r["chunk"] for r in recs)
+                    count = len(recs)
+                manifest_pdfs[key] = {**fingerprints[key], "start": n_rows, "end": n_rows + count}
+                n_rows += count
+
+    # embeddings：只 encode 新增/變動 PDF 的 chunk（一次 encode，保留 batching 效益）
+    new_emb = None
+    if new_texts:
+        model = load_model()
+        new_emb = encode_texts(model, new_texts).astype(np.float16)
+    # 向量以 FP16 保存（單位向量遠在 FP16 範圍內）；新舊向量同樣經過 FP16，增量與整批重建結果一致
+    emb16 = np.concatenate([(old_emb if src == "old" else new_emb)[a:b] for src, a, b in parts if b > a])
+    emb = emb16.astype(np.float32)
+
+    # index 一律用完整向量重建（訓練/建圖相對 encode 很便宜，也能處理刪除或變動的 PDF）
+    meta = read_chunks_csv()
+    index = build_index(emb, meta["vec_id"].to_numpy(dtype=np.int64))
+
+    faiss.write_index(index, str(OUT_DIR / "faiss.index"))
+
+    write_meta(meta)
+
+    np.save(OUT_DIR / "emb.npy", emb16)
+    manifest = {"config": build_config(), "pdfs": manifest_pdfs}
+    (OUT_DIR / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print("done")
+    print("chunks:", n_rows, f"(reused {len(reused)} PDFs, parsed {len(todo)} PDFs)")
+    print("index saved to:", OUT_DIR)
+
+
+if __name__ == "__main__":
+    main()